@@ -1,14 +1,21 @@
 """Check if it is bin day, and what bin needs taking out."""
 
 import enum
+import functools
+import hashlib
+import itertools
 import os
+import pickle
+import re
 from dataclasses import dataclass
 from datetime import datetime, timedelta
+from pathlib import Path
 
 import dotenv
+import lxml.etree
+import lxml.html
 import requests
 from RPi import GPIO
-from bs4 import BeautifulSoup
 
 
 dotenv.load_dotenv()
@@ -22,27 +29,118 @@ URL = (
     "/collection-search-results"
 )
 
+QUERY_PARAMS = {
+    "streetId": STREET_ID,
+    "streetName": STREET_NAME,
+}
+
+QUERY_HEADERS = {
+    "Content-Length": "0",
+    "Content-Type": "application/x-www-form-urlencoded; charset=UTF-8",
+    "Accept": "text/html, */*; q=0.01",
+    "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:148.0) Gecko/20100101 Firefox/148.0",
+}
+
 BIN_COLLECTION_TIME = 7  # 7.00 AM
 REMIND_HOURS_BEFORE = 16
 
+MONTHS = {
+    "january": 1,
+    "february": 2,
+    "march": 3,
+    "april": 4,
+    "may": 5,
+    "june": 6,
+    "july": 7,
+    "august": 8,
+    "september": 9,
+    "october": 10,
+    "november": 11,
+    "december": 12,
+}
+WEEKDAYS = {"monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"}
+STRIP_WHITESPACE = str.maketrans("", "", " \n\r\t")
+
+CACHE_PATH = Path.home() / ".cache" / "rubbish-day.pkl"
+CACHE_VERSION = 4
+
+SESSION = requests.Session()
+
 GPIO_PIN_RED = 17
 GPIO_PIN_GREEN = 27
+LED_PINS = (GPIO_PIN_RED, GPIO_PIN_GREEN)
+
+# (red pin, green pin) output levels for each LED color.
+LED_COLORS = {
+    "off": (GPIO.LOW, GPIO.LOW),
+    "red": (GPIO.HIGH, GPIO.LOW),
+    "green": (GPIO.LOW, GPIO.HIGH),
+    "orange": (GPIO.HIGH, GPIO.HIGH),
+}
+
+
+class Bin(enum.Flag):
+    RUBBISH = enum.auto()
+    GLASS_CRATE = enum.auto()
+    RECYCLING_BAG = enum.auto()
+
+
+COLLECTION_MAP = {
+    'Rubbish': Bin.RUBBISH,
+    'Glass crate': Bin.GLASS_CRATE,
+    'Wheelie bin or recycling bags': Bin.RECYCLING_BAG,
+}
+# Checked in order, the first bin going out this week picks the LED color.
+LED_PRIORITY = (
+    (Bin.RECYCLING_BAG, "red", 'Take recycling bag out!'),
+    (Bin.GLASS_CRATE, "green", 'Take glass crate out!'),
+)
+
+
+# Sections whose contents are not markup, so elements are not matched inside them.
+IGNORED_SECTIONS = (
+    r"<!--.*?(?:-->|\Z)"
+    r"|<(?i:script)(?=[\s>]).*?(?:</(?i:script)\s*>|\Z)"
+    r"|<(?i:style)(?=[\s>]).*?(?:</(?i:style)\s*>|\Z)"
+)
+# Any run of attributes, with quoted values allowed to contain '>'.
+ATTRIBUTES = r"""(?:[^>"']|"[^"]*"|'[^']*')*?"""
+
+
+def compile_element_patterns(tag: str, class_name: str) -> tuple[re.Pattern, re.Pattern]:
+    """Compile patterns matching the opening tag of a `tag` element whose
+    class list contains `class_name`, and the closing tag of that element.
+
+    The opening pattern also matches comments, scripts and styles so that a
+    left-to-right scan steps over them. Only matches of the `element` group
+    are real elements.
+    """
+    tag = re.escape(tag)
+    class_name = re.escape(class_name)
+    class_value = (
+        r'"(?:[^"]*\s)?{0}(?:\s[^"]*)?"'
+        r"|'(?:[^']*\s)?{0}(?:\s[^']*)?'"
+        r"|{0}(?=[\s>])"
+    ).format(class_name)
+    opening = r"{0}|(?P<element><(?i:{1})(?=[\s>]){2}\s(?i:class)\s*=\s*(?:{3}){2}>)".format(
+        IGNORED_SECTIONS, tag, ATTRIBUTES, class_value,
+    )
+    closing = r"</(?i:{0})\s*>".format(tag)
+    return re.compile(opening.encode(), re.S), re.compile(closing.encode())
 
 
-class Bin(enum.Enum):
-    RUBBISH = 0
-    GLASS_CRATE = 1
-    RECYCLING_BAG = 2
+COLLECTION_DATE_PATTERNS = compile_element_patterns("p", "collection-date")
+COLLECTION_ITEMS_PATTERNS = compile_element_patterns("ul", "collection-items")
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class RubbishDay:
     """RubbishDay is a dataclass for storing the next rubbish day
     date, and bin types.
     """
 
     date: datetime
-    bins: list[Bin]
+    bins: Bin
 
 
 class LEDController:
@@ -50,92 +148,202 @@ class LEDController:
 
     def __init__(self):
         GPIO.setmode(GPIO.BCM)
-        GPIO.setup(GPIO_PIN_RED, GPIO.OUT)
-        GPIO.setup(GPIO_PIN_GREEN, GPIO.OUT)
+        GPIO.setup(LED_PINS, GPIO.OUT)
+
+    def set_color(self, color: str):
+        GPIO.output(LED_PINS, LED_COLORS[color])
 
     def turn_off(self):
-        GPIO.output(GPIO_PIN_RED, GPIO.LOW)
-        GPIO.output(GPIO_PIN_GREEN, GPIO.LOW)
+        self.set_color("off")
 
     def turn_red(self):
-        GPIO.output(GPIO_PIN_RED, GPIO.HIGH)
-        GPIO.output(GPIO_PIN_GREEN, GPIO.LOW)
+        self.set_color("red")
 
     def turn_green(self):
-        GPIO.output(GPIO_PIN_RED, GPIO.LOW)
-        GPIO.output(GPIO_PIN_GREEN, GPIO.HIGH)
+        self.set_color("green")
 
     def turn_orange(self):
-        GPIO.output(GPIO_PIN_RED, GPIO.HIGH)
-        GPIO.output(GPIO_PIN_GREEN, GPIO.HIGH)
+        self.set_color("orange")
 
 
-def parse_response(html: bytes) -> RubbishDay:
-    """Parses a raw html response to extract relevant bin information.
+@functools.cache
+def get_led_controller() -> LEDController:
+    """Return the shared LEDController, setting up the GPIO pins on first use."""
+    return LEDController()
+
+
+@functools.lru_cache(maxsize=32)
+def parse_bin_date(date_raw: str) -> tuple[int, int]:
+    """Parses a whitespace-stripped date such as 'Tuesday,15October' into
+    a (month, day) tuple.
     """
-    collection_date_class = ("p", "collection-date")
-    collection_items_class = ("ul", "collection-items")
+    weekday, _, day_month = date_raw.lower().partition(',')
+    day = "".join(itertools.takewhile(str.isdigit, day_month))
+    month = MONTHS.get(day_month[len(day):])
+    if weekday not in WEEKDAYS or not day or not month:
+        raise ValueError("Could not parse collection date: {}".format(date_raw))
 
-    soup = BeautifulSoup(html, "html.parser")
+    return month, int(day)
 
-    collection_date_content = soup.find(
-        collection_date_class[0],
-        attrs={"class": collection_date_class[1]},
-    )
-    if not collection_date_content:
-        raise ValueError("Could not find collection date in response!")
 
-    collection_items_content = soup.find(
-        collection_items_class[0],
-        attrs={"class": collection_items_class[1]},
-    )
+def parse_element(html: bytes, patterns: tuple[re.Pattern, re.Pattern], name: str) -> lxml.html.HtmlElement:
+    """Parses a single html element out of the full response.
+
+    The html is sliced from the element's opening tag to its first closing
+    tag, or the end of the response if it has none, and lxml closes the
+    element wherever the full parse would have. Comments, scripts and styles
+    are skipped when looking for the opening tag. Unlike a full-page parse,
+    a closing tag inside a comment within the element ends the slice early.
+    """
+    opening, closing = patterns
+    start = next((match for match in opening.finditer(html) if match.lastgroup == "element"), None)
+    if not start:
+        raise ValueError("Could not find {} in response!".format(name))
+
+    end = closing.search(html, start.end())
+    fragment = html[start.start():end.end() if end else len(html)]
+    try:
+        return lxml.html.fragments_fromstring(fragment)[0]
+    except (IndexError, lxml.etree.ParserError):
+        raise ValueError("Could not find {} in response!".format(name)) from None
+
+
+def parse_collection(html: bytes) -> tuple[int, int, Bin]:
+    """Parses a raw html response into the (month, day, bins) of the next
+    collection. Unlike parse_response this does not depend on the clock,
+    so it is what gets cached.
+
+    Only the two elements of interest are located with a regex scan and
+    parsed, rather than building a tree for the whole page.
+    """
+    collection_date_content = parse_element(html, COLLECTION_DATE_PATTERNS, "collection date")
+    collection_items_content = parse_element(html, COLLECTION_ITEMS_PATTERNS, "collection items").findall("li")
     if not collection_items_content:
         raise ValueError("Could not find collection items in response!")
 
-    date_time_raw = collection_date_content.text.replace('\n', '').replace(' ', '').strip('\r')
-    date_raw = date_time_raw.split('(')[0]
-    parsed_bin_date = datetime.strptime(date_raw, r'%A,%d%B')
-    bin_date = datetime(datetime.now().year, parsed_bin_date.month, parsed_bin_date.day, BIN_COLLECTION_TIME)
-
-    collection_items = []
-    collection_map = {
-        'Rubbish': Bin.RUBBISH,
-        'Glass crate': Bin.GLASS_CRATE,
-        'Wheelie bin or recycling bags': Bin.RECYCLING_BAG,
-    }
-    for li_item in collection_items_content.find_all('li'):
-        bin_type = collection_map.get(li_item.text)
+    date_raw = collection_date_content.text_content().translate(STRIP_WHITESPACE).partition('(')[0]
+    month, day = parse_bin_date(date_raw)
+
+    collection_items = Bin(0)
+    for li_item in collection_items_content:
+        bin_type = COLLECTION_MAP.get(li_item.text_content())
         if not bin_type:
             raise AttributeError("Unknown bin type: {}".format(bin_type))
-        collection_items.append(bin_type)
+        collection_items |= bin_type
 
-    return RubbishDay(date=bin_date, bins=collection_items)
+    return month, day, collection_items
 
 
-def query_rubbish_day() -> RubbishDay:
-    """Query wellington council API for bin data."""
-    params = {
-        "streetId": STREET_ID,
-        "streetName": STREET_NAME,
-    }
+def build_rubbish_day(month: int, day: int, bins: Bin) -> RubbishDay:
+    """Builds a RubbishDay for a collection in the current year."""
+    bin_date = datetime(datetime.now().year, month, day, BIN_COLLECTION_TIME)
+    return RubbishDay(date=bin_date, bins=bins)
 
-    headers = {
-        "Content-Length": "0",
-        "Content-Type": "application/x-www-form-urlencoded; charset=UTF-8",
-        "Accept": "text/html, */*; q=0.01",
-        "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:148.0) Gecko/20100101 Firefox/148.0",
-    }
 
-    response = requests.post(URL, headers=headers, params=params)
+def parse_response(html: bytes) -> RubbishDay:
+    """Parses a raw html response to extract relevant bin information."""
+    return build_rubbish_day(*parse_collection(html))
+
+
+def load_cache() -> dict:
+    """Load the last response validators and parsed collection from disk.
+
+    Returns an empty dict if there is no usable cache.
+    """
+    try:
+        with open(CACHE_PATH, "rb") as cache_file:
+            cache = pickle.load(cache_file)
+    except (OSError, EOFError, AttributeError, pickle.UnpicklingError):
+        return {}
+
+    if not isinstance(cache, dict) or cache.get("version") != CACHE_VERSION:
+        return {}
+    if (cache.get("street_id"), cache.get("street_name")) != (STREET_ID, STREET_NAME):
+        return {}
+
+    return cache
+
+
+def save_cache(cache: dict) -> None:
+    """Write response validators and parsed collection to disk.
+
+    The cache is only an optimisation, so a cache that cannot be written is
+    skipped rather than failing the run.
+    """
+    try:
+        CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        with open(CACHE_PATH, "wb") as cache_file:
+            pickle.dump(
+                dict(cache, version=CACHE_VERSION, street_id=STREET_ID, street_name=STREET_NAME),
+                cache_file,
+            )
+    except OSError:
+        pass
+
+
+def cached_rubbish_day(cache: dict) -> RubbishDay | None:
+    """Rebuild the cached RubbishDay, or None if there is no cached
+    collection or its date has already passed.
+    """
+    if "collection" not in cache:
+        return None
+
+    rubbish_day = build_rubbish_day(*cache["collection"])
+    if rubbish_day.date < datetime.now():
+        return None
+
+    return rubbish_day
+
+
+def query_rubbish_day(cache: dict | None = None) -> RubbishDay:
+    """Query wellington council API for bin data.
+
+    Sends the validators from the previous response so the council can
+    answer 304 Not Modified, in which case the cached collection is reused.
+    Validators on a POST are best-effort: a server honouring RFC 9110
+    answers a matching If-None-Match with 412 instead, which is treated
+    the same way.
+    A full response whose body is identical to the last one is not re-parsed.
+    The cache is loaded from disk unless one is passed in, and is only used
+    while its collection date is still in the future.
+    """
+    if cache is None:
+        cache = load_cache()
+
+    cached = cached_rubbish_day(cache)
+    headers = QUERY_HEADERS
+    if cached:
+        headers = dict(QUERY_HEADERS)
+        if cache.get("etag"):
+            headers["If-None-Match"] = cache["etag"]
+        if cache.get("last_modified"):
+            headers["If-Modified-Since"] = cache["last_modified"]
+
+    response = SESSION.post(URL, headers=headers, params=QUERY_PARAMS)
+    if response.status_code in (304, 412) and cached:
+        return cached
     if not response.ok:
         raise RuntimeError("Response not ok! {}".format(response.content))
 
-    return parse_response(response.content)
+    body_hash = hashlib.blake2b(response.content, digest_size=16).digest()
+    if cached and cache.get("body_hash") == body_hash:
+        collection = cache["collection"]
+    else:
+        collection = parse_collection(response.content)
+
+    save_cache({
+        "body_hash": body_hash,
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+        "collection": collection,
+    })
+
+    return build_rubbish_day(*collection)
 
 
 def set_led_appropriately(rubbish_day: RubbishDay) -> bool:
     """Set LED light color based on bin type."""
-    led_controller = LEDController()
+    led_controller = get_led_controller()
     led_controller.turn_off()
 
     time_until_bin = rubbish_day.date - datetime.now()
@@ -143,16 +351,13 @@ def set_led_appropriately(rubbish_day: RubbishDay) -> bool:
         print('Bin day is still a way away')
         return False
 
-    if Bin.RECYCLING_BAG in rubbish_day.bins:
-        led_controller.turn_red()
-        print('Take recycling bag out!')
-    elif Bin.GLASS_CRATE in rubbish_day.bins:
-        print('Take glass crate out!')
-        led_controller.turn_green()
-    else:
-        raise AssertionError("Unreachable")
+    for bin_type, color, message in LED_PRIORITY:
+        if bin_type in rubbish_day.bins:
+            led_controller.set_color(color)
+            print(message)
+            return True
 
-    return True
+    raise AssertionError("Unreachable")
 
 
 def main() -> int:
@@ -160,7 +365,13 @@ def main() -> int:
     if not all(env for env in (STREET_ID, STREET_NAME)):
         raise RuntimeError("Make sure STREET_ID and STREET_NAME are defined!")
 
-    rubbish_day = query_rubbish_day()
+    # Skip the council query while the cached bin day is more than a day
+    # outside the reminder window, the schedule won't have changed by then.
+    cache = load_cache()
+    rubbish_day = cached_rubbish_day(cache)
+    if not rubbish_day or rubbish_day.date - datetime.now() < timedelta(hours=REMIND_HOURS_BEFORE + 24):
+        rubbish_day = query_rubbish_day(cache)
+
     changed = set_led_appropriately(rubbish_day)
 
     return 0 if changed else 1